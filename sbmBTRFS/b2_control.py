@@ -1,5 +1,7 @@
 """Setup and interface to b2 upload service."""
 
+from functools import cached_property  # python 3.8+
+
 from b2sdk.account_info.sqlite_account_info import SqliteAccountInfo
 from b2sdk.api import B2Api
 
@@ -12,7 +14,19 @@ class B2CloudInterface():
     """
 
     def __init__(self, arg):
-        """Initialize B2 connection and credentials."""
-        info = SqliteAccountInfo()  # creds and tokens in ~/.b2_account_info
-        b2_api = B2Api(info)
+        """Initialize B2 interface.
+
+        The connection and credentials are only set up when b2_api is first
+        used, see b2_api.
+        """
         self.arg = arg
+
+    @cached_property
+    def b2_api(self):
+        """Return B2 connection, created on first use.
+
+        Reading the account info opens its sqlite database, which is skipped
+        entirely by runs that never upload anything.
+        """
+        info = SqliteAccountInfo()  # creds and tokens in ~/.b2_account_info
+        return B2Api(info)
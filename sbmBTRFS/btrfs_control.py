@@ -1,10 +1,24 @@
-"""Python interface to btrfs-progs commands."""
+"""Python interface to btrfs-progs commands.
+
+Subvolume operations go through libbtrfsutil when its python bindings are
+installed, and fall back to calling btrfs-progs otherwise.
+"""
 
 import os.path
-import subprocess  # Calling btrfs commands
+import stat  # checking subvolume root inodes
 import logging
+import weakref  # snapshots refer back to their subvolume
+from bisect import bisect_right, insort
+from collections import deque
 from datetime import datetime
-from functools import total_ordering  # help with sorting methods
+from functools import lru_cache
+
+try:
+    # libbtrfsutil bindings issue the ioctls directly instead of spawning a
+    # btrfs-progs process for every operation
+    import btrfsutil
+except ImportError:
+    btrfsutil = None
 
 # TODO: remove in production version
 TESTING = True
@@ -12,12 +26,350 @@ TESTING = True
 # Setup module based logging, attaches to logger from parent module
 logger = logging.getLogger(__name__)
 
+# inode number of the root directory of every btrfs subvolume
+SUBVOLUME_ROOT_INODE = 256
+
+# btrfs-progs command prefixes, built once instead of on every call
+_BTRFS_SUBVOL_CREATE = ("btrfs", "subvolume", "create")
+_BTRFS_SUBVOL_DELETE = ("btrfs", "subvolume", "delete")
+_BTRFS_SUBVOL_SHOW = ("btrfs", "subvolume", "show")
+_BTRFS_SNAPSHOT = ("btrfs", "subvolume", "snapshot")
+_BTRFS_SNAPSHOT_RO = ("btrfs", "subvolume", "snapshot", "-r")
+_BTRFS_SEND = ("btrfs", "send")
+_BTRFS_RECEIVE_DUMP = ("btrfs", "receive", "--dump")
+
+# directory snapshot diffs are written to when not streamed elsewhere
+TMP_DIR = os.path.join("/", "tmp")
+
+
+def _run(argv, stdout=None):
+    """Run a btrfs-progs command and log its output.
+
+    stdout is only ever logged at debug level, so it is only captured when
+    debug logging is enabled and sent to /dev/null otherwise.
+    Keyword arguments:
+    argv -- command and arguments as list
+    stdout -- file object or descriptor to send stdout to instead (optional)
+
+    Returns subprocess.CompletedProcess
+    """
+    # imported here, runs that never call btrfs-progs don't need it
+    import subprocess
+    capture_stdout = stdout is None and logger.isEnabledFor(logging.DEBUG)
+    if capture_stdout:
+        stdout = subprocess.PIPE
+    elif stdout is None:
+        stdout = subprocess.DEVNULL
+    return_val = subprocess.run(argv, stdout=stdout, stderr=subprocess.PIPE)
+    # output is bytes, decode it once so it is logged as text rather than
+    # as a bytes repr
+    if capture_stdout and return_val.stdout:
+        logger.debug("%s", _decode_output(return_val.stdout))
+    # btrfs-progs also writes progress such as btrfs send's "At subvol" to
+    # stderr, only an error if the command failed
+    if return_val.returncode != 0:
+        logger.error("%s failed: %s", " ".join(argv[:3]),
+                     _decode_output(return_val.stderr)
+                     )
+    elif return_val.stderr:
+        logger.debug("%s", _decode_output(return_val.stderr))
+    return return_val
+
+
+def _decode_output(output):
+    """Return btrfs-progs output bytes as text without trailing newline."""
+    return output.decode(errors="replace").rstrip("\n")
+
+
+@lru_cache(maxsize=4096)
+def _subvolume_exists(path):
+    """Check if path is the root of a btrfs subvolume on disk.
+
+    A single stat() call is enough since the root directory of a subvolume
+    always has inode 256. Only falls back to btrfs subvolume show if path
+    could not be stat'ed for a reason other than not existing.
+    Results are cached per path, the helpers below that create or delete
+    subvolumes clear the cache.
+    """
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        if btrfsutil:
+            try:
+                return btrfsutil.is_subvolume(path)
+            except btrfsutil.BtrfsUtilError as e:
+                logger.error(e)
+                return False
+        import subprocess  # see _run
+        return_val = subprocess.run(
+            [*_BTRFS_SUBVOL_SHOW, path],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        if return_val.returncode != 0:
+            logger.error("%s", _decode_output(return_val.stderr))
+            return False
+        else:
+            return True
+    return (path_stat.st_ino == SUBVOLUME_ROOT_INODE
+            and stat.S_ISDIR(path_stat.st_mode))
+
+
+def _list_subvolumes(path):
+    """Return the set of normalized paths of subvolumes below path.
+
+    One pass over the directory instead of a separate check per candidate.
+    libbtrfsutil walks the subvolume tree with a single iterator, otherwise
+    each directory entry is stat'ed and checked as in _subvolume_exists.
+    Returns None if the scan failed, a partial result would mark snapshots
+    that do exist as missing.
+    """
+    found = set()
+    if btrfsutil:
+        try:
+            with btrfsutil.SubvolumeIterator(path) as it:
+                for subvol_path, _ in it:
+                    found.add(os.path.normpath(
+                        os.path.join(path, subvol_path)))
+        except btrfsutil.BtrfsUtilError as e:
+            logger.error(e)
+            return None
+        return found
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                # readdir reports the subvolume id as inode, stat the entry
+                entry_stat = entry.stat(follow_symlinks=False)
+                if (entry_stat.st_ino == SUBVOLUME_ROOT_INODE
+                        and stat.S_ISDIR(entry_stat.st_mode)):
+                    found.add(os.path.normpath(entry.path))
+    except OSError as e:
+        logger.error(e)
+        return None
+    return found
+
+
+def _create_subvolume(path):
+    """Create a subvolume at path, with libbtrfsutil if it is available."""
+    if btrfsutil:
+        try:
+            btrfsutil.create_subvolume(path)
+        except btrfsutil.BtrfsUtilError as e:
+            logger.error(e)
+    else:
+        _run([*_BTRFS_SUBVOL_CREATE, path])
+    _subvolume_exists.cache_clear()
+
+
+def _create_snapshot(source, path, read_only):
+    """Snapshot source at path, with libbtrfsutil if it is available."""
+    if btrfsutil:
+        try:
+            btrfsutil.create_snapshot(source, path, read_only=read_only)
+        except btrfsutil.BtrfsUtilError as e:
+            logger.error(e)
+    elif read_only:
+        _run([*_BTRFS_SNAPSHOT_RO, source, path])
+    else:
+        _run([*_BTRFS_SNAPSHOT, source, path])
+    _subvolume_exists.cache_clear()
+
+
+def _delete_subvolume_recursive(path):
+    """Delete the subvolume at path and every subvolume below it.
+
+    Only possible with libbtrfsutil, which walks the nested subvolumes in the
+    kernel.
+    """
+    try:
+        btrfsutil.delete_subvolume(path, recursive=True)
+    except btrfsutil.BtrfsUtilError as e:
+        logger.error(e)
+    _subvolume_exists.cache_clear()
+
+
+def _delete_subvolumes(paths):
+    """Delete the subvolumes at paths, with libbtrfsutil if it is available.
+
+    Without libbtrfsutil all paths are passed to a single btrfs-progs call.
+    """
+    if btrfsutil:
+        for path in paths:
+            try:
+                btrfsutil.delete_subvolume(path)
+            except btrfsutil.BtrfsUtilError as e:
+                logger.error(e)
+    else:
+        _run([*_BTRFS_SUBVOL_DELETE, *paths])
+    _subvolume_exists.cache_clear()
+
+
+def _stream_buffer_argv(size):
+    """Return argv of a stream buffer holding size bytes, or None.
+
+    Used between btrfs send and its consumer so a slow consumer doesn't
+    stall send and the other way around. mbuffer is used if it is
+    installed, otherwise pv.
+    """
+    import shutil  # only needed to look up the buffer command
+    if shutil.which("mbuffer"):
+        return ["mbuffer", "-q", "-s", "128k", "-m", str(size)]
+    elif shutil.which("pv"):
+        return ["pv", "-q", "-B", str(size)]
+    else:
+        logger.warning("Neither mbuffer nor pv found, "
+                       "sending without stream buffer")
+        return None
+
+
+def _run_pipeline(commands, capture=False, stdout=None):
+    """Run commands with the stdout of each piped into the next one.
+
+    The stream is passed between the processes by the kernel and never
+    read by this process. stderr of every command goes to a temporary file,
+    nothing reads a pipe from them while they run and a full stderr pipe
+    would block them and stall the whole pipeline. This includes the last
+    command, which is the mbuffer or pv stage when a send is buffered.
+    Keyword arguments:
+    commands -- list of argv lists, the first one usually btrfs send
+    capture -- whether to return the output of the last command
+    stdout -- file object or file descriptor the last command writes to,
+    if not captured (optional)
+
+    Returns the output of the last command as text if capture is set,
+    otherwise an empty string. Returns None if any command failed.
+    """
+    import subprocess  # see _run
+    import tempfile  # stderr of the commands
+    procs = []
+    stdin = None
+    for argv in commands[:-1]:
+        stderr_file = tempfile.TemporaryFile()
+        proc = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE,
+                                stderr=stderr_file)
+        if stdin is not None:
+            stdin.close()  # only the next command reads it
+        procs.append((proc, stderr_file))
+        stdin = proc.stdout
+    if capture:
+        stdout = subprocess.PIPE
+    elif stdout is None:
+        stdout = subprocess.DEVNULL
+    last_stderr_file = tempfile.TemporaryFile()
+    last = subprocess.Popen(commands[-1], stdin=stdin, stdout=stdout,
+                            stderr=last_stderr_file)
+    if stdin is not None:
+        stdin.close()
+    output, _ = last.communicate()
+    failed = last.returncode != 0
+    last_stderr_file.seek(0)
+    stderr = last_stderr_file.read()
+    last_stderr_file.close()
+    for proc, stderr_file in procs:
+        if proc.wait() != 0:
+            failed = True
+        stderr_file.seek(0)
+        stderr = stderr_file.read() + stderr
+        stderr_file.close()
+    if failed:
+        logger.error("%s failed: %s",
+                     " | ".join(argv[0] for argv in commands),
+                     _decode_output(stderr)
+                     )
+        return None
+    return _decode_output(output) if capture else ""
+
+
+def _send_stream(commands, stdout):
+    """Run btrfs send, piped through a stream buffer if there is one.
+
+    Returns True if every command succeeded.
+    """
+    if len(commands) == 1:
+        return _run(commands[0], stdout=stdout).returncode == 0
+    else:
+        return _run_pipeline(commands, stdout=stdout) is not None
+
+
+def _send_to_file(commands, path):
+    """Write the stream of _send_stream to a new file at path.
+
+    Any existing file at path is removed first and the new one is created
+    exclusively without following symlinks, so nothing planted at the
+    predictable path in /tmp is written through. The size is read with
+    fstat on the same descriptor.
+    Returns size of the file, or None if the send failed, in which case the
+    file is removed again.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(path,
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                     0o600)
+    except OSError as e:
+        logger.error(e)
+        return None
+    try:
+        if _send_stream(commands, fd):
+            return os.fstat(fd).st_size
+        os.unlink(path)  # truncated stream
+        return None
+    finally:
+        os.close(fd)
+
+
+if TESTING:
+    # dry run, the btrfs-progs commands are printed instead of run. The
+    # helpers are swapped once here so the classes below don't have to check
+    # TESTING on every operation
+    btrfsutil = None
+
+    def _run(argv, stdout=None):
+        """Print argv instead of running it."""
+        print(" ".join(argv))
+
+    @lru_cache(maxsize=4096)  # same interface as the real one
+    def _subvolume_exists(path):
+        """Treat every path as an existing subvolume."""
+        return True
+
+    def _list_subvolumes(path):
+        """Return None, nothing on disk is listed in a dry run."""
+        return None
+
+    def _send_stream(commands, stdout):
+        """Print the send commands, returns True as nothing can fail."""
+        print(" | ".join(" ".join(argv) for argv in commands))
+        return True
+
+    def _send_to_file(commands, path):
+        """Print the send commands, no file is created in a dry run."""
+        print(" | ".join(" ".join(argv) for argv in commands) + " > " + path)
+        return 0
+
+    def _run_pipeline(commands, capture=False, stdout=None):
+        """Print the pipeline instead of running it.
+
+        There is no output to return, so None is returned if capture is set.
+        """
+        print(" | ".join(" ".join(argv) for argv in commands))
+        return None if capture else ""
+
+
 # TODO: Need to capture errors from btrfs commands as exceptions
 # TODO: Change snapshot type into an enum
-@total_ordering
 class Subvolume:
     """Represents a btrfs subvolume."""
 
+    # fixed set of attributes, no per instance __dict__
+    __slots__ = ("path", "name", "snapshots_subvol", "snapshots_path",
+                 "_snapshots_by_type", "keep_snapshots", "physical",
+                 "_snapshots", "_newest", "__weakref__")
+
     def __init__(self, path, snapshots_subvol, hourly, daily,
                  weekly, monthly, yearly):
         """Initialize Subvolume class at path.
@@ -29,12 +381,16 @@ class Subvolume:
         self.path = path
         self.name = os.path.basename(os.path.normpath(path))
         self.snapshots_subvol = snapshots_subvol
-        self.num_snapshots = {
-            'hourly': 0,
-            'daily': 0,
-            'weekly': 0,
-            'monthly': 0,
-            'yearly': 0
+        # directory new snapshots are placed in, joined once here
+        self.snapshots_path = os.path.join(self.path, self.snapshots_subvol)
+        # snapshots of each type, oldest first
+        self._snapshots_by_type = {
+            'init': deque(),
+            'hourly': deque(),
+            'daily': deque(),
+            'weekly': deque(),
+            'monthly': deque(),
+            'yearly': deque()
         }
         self.keep_snapshots = {
             'hourly': hourly,
@@ -48,11 +404,12 @@ class Subvolume:
         if self.exists(self.path):
             self.physical = True
             # if .snapshots subvolume exists, otherwise create it
-            if not self.exists(os.path.join(self.path, self.snapshot_subvol)):
-                self.create(os.path.join(self.path, self.snapshot_subvol))
+            if not self.exists(self.snapshots_path):
+                self.create(self.snapshots_path)
         else:
             self.physical = False
         self._snapshots = []
+        self._newest = None  # newest snapshot, kept current on add/remove
 
     def __repr__(self):
         """Return string representation of class."""
@@ -88,24 +445,33 @@ class Subvolume:
         """
         return self.name < other.name
 
+    # written out instead of using total_ordering, which routes every
+    # comparison through __lt__ and __eq__
+    def __le__(self, other):
+        """Check if subvolume is less than or equal to another subvolume."""
+        return self.name <= other.name
+
+    def __gt__(self, other):
+        """Check if subvolume is greater than another subvolume."""
+        return self.name > other.name
+
+    def __ge__(self, other):
+        """Check if subvolume is greater than or equal to another subvolume."""
+        return self.name >= other.name
+
+    @property
+    def num_snapshots(self):
+        """Return number of known snapshots of each type."""
+        return {type_: len(snapshots)
+                for type_, snapshots in self._snapshots_by_type.items()}
+
     @classmethod
     def exists(cls, path):
         """Check if path corresponds to a subvolume on disk.
 
-        Uses btrfs subvolume show command to detect if a subvolume exists.
+        Checks the inode number of path, see _subvolume_exists.
         """
-        if TESTING:
-            return True
-        else:
-            return_val = subprocess.run(
-                ["btrfs", "subvolume", "show", path],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE)
-            if return_val.returncode != 0:
-                logger.error(return_val.stderr)
-                return False
-            else:
-                return True
+        return _subvolume_exists(path)
 
     @classmethod
     def create(cls, path):
@@ -114,16 +480,8 @@ class Subvolume:
         Uses btrfs-progs subvolume command to create a new subvolume.
         Only used to create .snapshots subvolume if it doesn't exist
         """
-        if TESTING:
-            print(f"btrfs subvolume create {path}")
-        else:
-            return_val = subprocess.run(
-                        ["btrfs", "subvolume", "create", path],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-            logger.debug(return_val.stdout)
-            logger.error(return_val.stderr)
-        logger.info(f"Creating new subvolume at {path}")
+        _create_subvolume(path)
+        logger.info("Creating new subvolume at %s", path)
 
     @classmethod
     def delete(cls, path):
@@ -132,23 +490,26 @@ class Subvolume:
         Uses btrfs-progs subvolume command to delete a subvolume. Cannot
         recursively delete subvolumes. Only used to delete .snapshots subvolume
         """
-        if cls.physical:
-            if TESTING:
-                print(f"btrfs subvolume delete {path}")
-            else:
-                return_val = subprocess.run(
-                            ["btrfs", "subvolume", "delete", path],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-                logger.debug(return_val.stdout)
-                logger.error(return_val.stderr)
-            logger.info(f"Deleting subvolume at {path}")
+        if cls.exists(path):
+            _delete_subvolumes([path])
+            logger.info("Deleting subvolume at %s", path)
 
         else:
-            logger.error(f"Could not delete subvolume at {path}."
-                         f"Did not exist on disk"
+            logger.error("Could not delete subvolume at %s. "
+                         "Did not exist on disk", path
                          )
 
+    def scan_snapshots(self):
+        """Return the paths of all snapshots on disk in snapshots_path.
+
+        Used to mark snapshots loaded from the config as physical with one
+        scan of the snapshots subvolume. Returns None if that is not possible
+        and each snapshot has to be checked with Snapshot.exists instead.
+        """
+        if not self.physical:
+            return None
+        return _list_subvolumes(self.snapshots_path)
+
     def take_snapshot(self, type_, ro=True):
         """Take a snapshot of a btrfs subvolume.
 
@@ -160,74 +521,179 @@ class Subvolume:
         See the documentation of btrfs subvolume for further details.
         type -- indicates type of snapshot
         ro -- whether to take a read only snapshot
-        Returns a snapshot object.
+        Returns a snapshot object, or None if an hourly snapshot without
+        changes was discarded.
         """
-        # TODO: check if snapshot diff is empty, if it is discard snapshot.
-        # This won't affect backup stuff, since the btrfs incremental send
-        # will be between the previously saved snapshot, which is the one
-        # before deleted snapshot
         if self.physical:
-            time_now = datetime.now()
-            snapshot_name = self.name + "-" + str(time_now.isoformat())
-            snapshot_path = os.path.join(self.path, self.snapshot_subvol,
-                                         snapshot_name
-                                         )
+            previous = self._newest
+            # whole seconds, microseconds only make names longer and are lost
+            # in the integer ctime stored in the config anyway. The compact
+            # basic format sorts the same and keeps colons out of paths
+            time_now = datetime.now().replace(microsecond=0)
+            snapshot_name = (self.name + "-"
+                             + time_now.strftime("%Y%m%dT%H%M%S"))
+            # more than one snapshot in the same second gets a counter
+            # suffix. Those are always the newest, at the end of _snapshots
+            same_second = set()
+            for snapshot in reversed(self._snapshots):
+                if not snapshot.name.startswith(snapshot_name):
+                    break
+                same_second.add(snapshot.name)
+            base_name = snapshot_name
+            counter = 1
+            while snapshot_name in same_second:
+                snapshot_name = f"{base_name}-{counter}"
+                counter += 1
+            snapshot_path = f"{self.snapshots_path}/{snapshot_name}"
             if ro:
-                if TESTING:
-                    print(f"btrfs subvolume snapshot "
-                          f"-r {self.path} {snapshot_path}"
-                          )
-                else:
-                    return_val = subprocess.run(
-                        ["btrfs", "subvolume", "snapshot", "-r",
-                            self.path, snapshot_path],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-                logger.info(f"Taking new read only snapshot of "
-                            f"{self.path} at {snapshot_path}"
+                _create_snapshot(self.path, snapshot_path, True)
+                logger.info("Taking new read only snapshot of %s at %s",
+                            self.path, snapshot_path
                             )
             else:
-                if TESTING:
-                    print(f"btrfs subvolume snapshot "
-                          f"{self.path} {snapshot_path}"
-                          )
-                else:
-                    return_val = subprocess.run(
-                        ["btrfs", "subvolume", "snapshot", self.path,
-                            snapshot_path],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-                logger.info(f"Taking new snapshot of {self.path} "
-                            f"at {snapshot_path}"
+                _create_snapshot(self.path, snapshot_path, False)
+                logger.info("Taking new snapshot of %s at %s",
+                            self.path, snapshot_path
                             )
-            if not TESTING:
-                # log stdout and stderr from btrfs commands
-                logger.debug(return_val.stdout)
-                logger.error(return_val.stderr)
             temp_snapshot = Snapshot(snapshot_name, snapshot_path, type_,
                                      time_now, self, ro
                                      )
+            # discard the snapshot if nothing changed since the previous one.
+            # This won't affect backup stuff, since the btrfs incremental send
+            # will be between the previously saved snapshot, which is the one
+            # before deleted snapshot. Only hourly ones, the other types are
+            # only taken at their boundary and would never be filled for an
+            # idle subvolume
+            if (type_ == "hourly" and ro and previous is not None
+                    and previous.read_only and previous.physical
+                    and temp_snapshot.physical):
+                snapshot_changed, _ = previous.snapshot_diff_check(
+                                      temp_snapshot)
+                if not snapshot_changed:
+                    logger.info("No changes since %s, discarding %s",
+                                previous.name, snapshot_name
+                                )
+                    temp_snapshot.delete()
+                    return None
             self._snapshots.append(temp_snapshot)
-            self.num_snapshots[type_] += 1
+            self._snapshots_by_type[type_].append(temp_snapshot)
+            self._newest = temp_snapshot  # always newer than anything known
             return temp_snapshot
         else:
-            logger.error(f"subvolume {self.name} does not exist on disk. "
-                         f"Cannot take snapshot!"
+            logger.error("subvolume %s does not exist on disk. "
+                         "Cannot take snapshot!", self.name
                          )
 
     def delete_snapshot(self, snapshot):
         """Delete snapshot from subvolume list."""
-        self.num_snapshots[snapshot.type_] -= 1
         snapshot.delete()
         self._snapshots.remove(snapshot)
+        self._snapshots_by_type[snapshot.type_].remove(snapshot)
+        # only update when the newest snapshot was the one removed, the
+        # list is kept sorted so the new newest is the last one
+        if snapshot is self._newest:
+            self._newest = self._snapshots[-1] if self._snapshots else None
+
+    def delete_snapshots(self, snapshots):
+        """Delete multiple snapshots from subvolume list.
+
+        btrfs subvolume delete accepts several paths, so all snapshots that
+        exist on disk are removed with a single btrfs-progs invocation rather
+        than one per snapshot.
+        """
+        deleted = {id(snapshot) for snapshot in snapshots}
+        for type_ in {snapshot.type_ for snapshot in snapshots}:
+            self._snapshots_by_type[type_] = deque(
+                snapshot for snapshot in self._snapshots_by_type[type_]
+                if id(snapshot) not in deleted
+                )
+        self._delete_snapshots(snapshots)
+
+    def delete_snapshots_subvolume(self, snapshots):
+        """Delete snapshots along with the snapshots subvolume holding them.
+
+        With libbtrfsutil the snapshots subvolume is deleted recursively,
+        which removes every snapshot inside it in one call, and only
+        snapshots stored elsewhere are deleted separately. Otherwise the
+        snapshots and then the snapshots subvolume are deleted by a single
+        btrfs-progs call.
+        Keyword arguments:
+        snapshots -- snapshots of this subvolume that exist on disk
+        """
+        if btrfsutil:
+            prefix = self.snapshots_path + "/"
+            self.delete_snapshots([snapshot for snapshot in snapshots
+                                   if not snapshot.path.startswith(prefix)])
+            _delete_subvolume_recursive(self.snapshots_path)
+            logger.info("Deleting subvolume at %s and all snapshots in it",
+                        self.snapshots_path
+                        )
+        else:
+            paths = [snapshot.path for snapshot in snapshots]
+            paths.append(self.snapshots_path)  # deleted last
+            _delete_subvolumes(paths)
+            logger.info("Deleting subvolumes at %s", ", ".join(paths))
+        self._snapshots = []
+        for type_snapshots in self._snapshots_by_type.values():
+            type_snapshots.clear()
+        self._newest = None
+
+    def prune_snapshots(self):
+        """Delete the oldest snapshots of each type over their keep limit.
+
+        Snapshots of each type are stored oldest first, so expired snapshots
+        are popped off the front of their deque. The work done is proportional
+        to the number of snapshots deleted.
+        Returns True if any snapshots were deleted.
+        """
+        expired = []
+        for type_, keep in self.keep_snapshots.items():
+            snapshots = self._snapshots_by_type[type_]
+            while len(snapshots) > keep:
+                expired.append(snapshots.popleft())
+        if expired:
+            # one btrfs call for every snapshot being removed
+            self._delete_snapshots(expired)
+        return bool(expired)
+
+    def _delete_snapshots(self, snapshots):
+        """Delete snapshots on disk and drop them from snapshot list.
+
+        Caller is responsible for removing them from _snapshots_by_type.
+        """
+        paths = []
+        for snapshot in snapshots:
+            if snapshot.physical:
+                paths.append(snapshot.path)
+            else:
+                logger.error("Could not delete snapshot at %s. "
+                             "Did not exist on disk.", snapshot.path
+                             )
+        if paths:
+            _delete_subvolumes(paths)
+            logger.info("Deleting snapshots at %s", ", ".join(paths))
+        deleted = {id(snapshot) for snapshot in snapshots}
+        self._snapshots = [snapshot for snapshot in self._snapshots
+                           if id(snapshot) not in deleted]
+        if id(self._newest) in deleted:
+            self._newest = self._snapshots[-1] if self._snapshots else None
 
     def append_snapshot(self, snapshot):
         """Append precreated snapshot object to list of snapshots.
 
+        The snapshot is inserted at its sorted position, so the snapshot
+        list and per type deques stay ordered oldest first without sorting.
+        Snapshots read in creation order are simply appended.
         currently only used when reading existing config file
         """
-        self._snapshots.append(snapshot)
-        self.num_snapshots[snapshot.type_] += 1
+        if self._newest is None or not snapshot < self._newest:
+            self._snapshots.append(snapshot)
+            self._snapshots_by_type[snapshot.type_].append(snapshot)
+            self._newest = snapshot
+        else:
+            insort(self._snapshots, snapshot)
+            snapshots = self._snapshots_by_type[snapshot.type_]
+            snapshots.insert(bisect_right(snapshots, snapshot), snapshot)
 
     def list_snapshots(self):
         """List snapshots in Subvolume with index."""
@@ -249,59 +715,64 @@ class Subvolume:
 
         If type is not none, return newest snapshot of type known to subvolume.
         """
-        self.sort()  # make sure list of snapshots is sorted asending
         if type_:
-            # create a new list with just type_ snapshots in order
-            sublist = [snapshot for snapshot in self._snapshots
-                       if snapshot.type_ == type_]
-            sublist.sort()
-            return sublist[-1]  # return last (newest) snapshot of type in list
+            # snapshots of each type are kept oldest first
+            return self._snapshots_by_type[type_][-1]
         else:
-            return self._snapshots[-1]  # return last (newest) snapshot in list
+            return self._newest  # maintained on add/remove, no sort needed
 
     def oldest_snapshot(self, type_=None):
         """Return oldest snapshot known to subvolume.
 
         If type is not none, return oldest snapshot of type known to subvolume.
         """
-        self.sort()  # make sure list of snapshots is sorted asending
         if type_:
-            # create a new list with just type_ snapshots in order
-            sublist = [snapshot for snapshot in self._snapshots
-                       if snapshot.type_ == type_]
-            sublist.sort()
-            return sublist[0]  # return first (oldest) snapshot of type in list
+            # snapshots of each type are kept oldest first
+            return self._snapshots_by_type[type_][0]
         else:
-            return self._snapshots[0]  # return first (oldest) snapshot in list
+            # _snapshots is kept in creation date order
+            return self._snapshots[0]
 
-    def sort(self):
-        """Sort snapshots in Subvolume."""
-        self._snapshots.sort()
 
-
-@total_ordering  # add extra comparison operators
 class Snapshot():
     """Represents a btrfs snapshot."""
 
+    # one instance per snapshot in the config, no per instance __dict__
+    __slots__ = ("name", "path", "type_", "creation_date_time", "read_only",
+                 "_subvolume", "physical", "__weakref__")
+
     def __init__(self, name, path, type_, creation_date_time,
-                 subvolume, read_only):
-        """Initialize Snapshot class."""
+                 subvolume, read_only, physical=None):
+        """Initialize Snapshot class.
+
+        physical can be passed if it is already known, for example from
+        Subvolume.scan_snapshots, otherwise self.exists() is checked.
+        """
         self.name = name
         self.path = path
         self.type_ = type_
         self.creation_date_time = creation_date_time
         self.read_only = read_only
-        self.subvolume = subvolume
+        # weak reference, the subvolume already holds its snapshots and a
+        # strong one both ways makes a cycle only the cyclic gc can free
+        self._subvolume = weakref.ref(subvolume)
         # if the snapshot physically exists, otherwise mark as non physical
         # and log
-        if self.exists(self.path):
+        if physical is not None:
+            self.physical = physical
+        elif self.exists():
             self.physical = True
         else:
             self.physical = False
 
+    @property
+    def subvolume(self):
+        """Return the Subvolume this is a snapshot of."""
+        return self._subvolume()
+
     def __repr__(self):
         """Return string representation of class."""
-        return f"Snapshot {self.name} of {self.type} at {self.path}"
+        return f"Snapshot {self.name} of {self.type_} at {self.path}"
 
     def __eq__(self, other):
         """Check if Snapshots are equal."""
@@ -321,23 +792,24 @@ class Snapshot():
         """
         return self.creation_date_time < other.creation_date_time
 
+    def __le__(self, other):
+        """Check if snapshot was created no later than the other."""
+        return self.creation_date_time <= other.creation_date_time
+
+    def __gt__(self, other):
+        """Check if snapshot was created later than the other."""
+        return self.creation_date_time > other.creation_date_time
+
+    def __ge__(self, other):
+        """Check if snapshot was created no earlier than the other."""
+        return self.creation_date_time >= other.creation_date_time
+
     def exists(self):
         """Check if snapshot object corresponds to a subvolume on disk.
 
-        Uses btrfs subvolume show command to detect if a subvolume exists.
+        Checks the inode number of path, see _subvolume_exists.
         """
-        if TESTING:
-            return True
-        else:
-            return_val = subprocess.run(
-                ["btrfs", "subvolume", "show", self.path],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE)
-            if return_val.returncode != 0:
-                logger.error(return_val.stderr)
-                return False
-            else:
-                return True
+        return _subvolume_exists(self.path)
 
     def delete(self):
         """Delete the btrfs snapshot it is called on.
@@ -346,19 +818,11 @@ class Snapshot():
         recursively delete subvolumes.
         """
         if self.physical:
-            if TESTING:
-                print(f"btrfs subvolume delete {self.path}")
-            else:
-                return_val = subprocess.run(
-                            ["btrfs", "subvolume", "delete", self.path],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-                logger.debug(return_val.stdout)
-                logger.error(return_val.stderr)
-            logger.info(f"Deleting snapshot at {self.path}")
+            _delete_subvolumes([self.path])
+            logger.info("Deleting snapshot at %s", self.path)
         else:
-            logger.error(f"Could not delete snapshot at {self.path}."
-                         f"Did not exist on disk."
+            logger.error("Could not delete snapshot at %s. "
+                         "Did not exist on disk.", self.path
                          )
 
     def snapshot_diff_check(self, new):
@@ -367,53 +831,136 @@ class Snapshot():
         Keyword arguments:
         new -- snapshot object.
 
+        Only the metadata of the incremental send stream is generated, with
+        btrfs send --no-data, and listed with btrfs receive --dump. This is
+        proportional to the number of changed inodes rather than the amount
+        of changed data.
+
         returns (bool, string)
         -- bool = True if there are any material differences between the
         two snapshots
         -- string = list of files that changed during shapshot
         """
-        # TODO: utilize btrfs-snapshot-diff to do this once it is refactored.
-        pass
+        send_argv = [*_BTRFS_SEND, "--no-data", "-q", "-p", self.path,
+                     new.path]
+        dump = _run_pipeline([send_argv, _BTRFS_RECEIVE_DUMP], capture=True)
+        if dump is None:
+            # can't tell, so treat as changed and keep the snapshot
+            logger.debug("Could not list changes between %s and %s, "
+                         "treating them as different", self.name, new.name
+                         )
+            return (True, "")
+        # one command per line: command, path, then its arguments. Every
+        # incremental stream starts with the snapshot command for the root
+        # of new, and the root always gets a utimes as well, even with
+        # nothing changed. Neither of those is a change
+        changed_files = {}  # dict keeps order and drops repeated paths
+        root_path = None
+        for line in dump.splitlines():
+            fields = line.split(None, 2)
+            if len(fields) < 2:
+                continue
+            command, path = fields[0], fields[1]
+            if command == "snapshot":
+                root_path = path
+            elif not (command == "utimes" and path == root_path):
+                changed_files[path] = None
+        return (bool(changed_files), "\n".join(changed_files))
+
+    def export_snapshot_diff(self, new=None, sink=None,
+                             stream_buffer_bytes=None):
+        """Output diff between two snapshots (subvolumes) to a file or sink.
+
+        Without a sink the send stream is written to a file in /tmp. With a
+        sink it is streamed straight into it, so a consumer such as a pipe to
+        btrfs receive or an uploader gets it without it being stored first.
+        Keyword arguments:
+        new -- snapshot object. (optional)
+        sink -- file object or file descriptor to write the send stream to.
+        (optional)
+        stream_buffer_bytes -- size of a stream buffer between btrfs send and
+        the file or sink, see _stream_buffer_argv. (optional)
+
+        Returns (path, size) of the snapshot diff file, or None if it was
+        written to sink or could not be sent
+        """
+        commands = self._send_commands(new, stream_buffer_bytes)
+        if commands is None:
+            return None
+        if new and new.physical:
+            diff_filename = (self.name + "::" + new.name)
+        else:
+            diff_filename = "init" + "::" + self.name
+
+        if sink is None:
+            diff_filepath = f"{TMP_DIR}/{diff_filename}"
+            destination = diff_filepath
+            size = _send_to_file(commands, diff_filepath)
+            result = None if size is None else (diff_filepath, size)
+            sent = result is not None
+        else:
+            destination = "stream"
+            result = None
+            sent = _send_stream(commands, sink)
+        if not sent:
+            logger.error("Could not send %s to %s", self.name, destination)
+        elif new and new.physical:
+            logger.info("Sending difference between %s and %s to %s",
+                        self.name, new.name, destination
+                        )
+        else:
+            logger.info("Sending %s to %s", self.name, destination)
+
+        return result  # path and size of snapshot diff
 
-    def export_snapshot_diff(self, new=None):
-        """Output diff between two snapshots (subvolumes) to a file.
+    def export_snapshot_diff_stream(self, receiver_argv, new=None,
+                                    stream_buffer_bytes=None):
+        """Pipe diff between two snapshots (subvolumes) into a command.
 
+        btrfs send is piped directly into receiver_argv, for example btrfs
+        receive or ssh, so the stream is never written to disk on this side.
         Keyword arguments:
+        receiver_argv -- argv list of a command reading the send stream on
+        its stdin
         new -- snapshot object. (optional)
+        stream_buffer_bytes -- size of a stream buffer between btrfs send and
+        receiver_argv, see _stream_buffer_argv. (optional)
+
+        Returns True if the stream was sent and received successfully.
+        """
+        commands = self._send_commands(new, stream_buffer_bytes)
+        if commands is None:
+            return False
+        destination = " ".join(receiver_argv)
+        if new and new.physical:
+            logger.info("Sending difference between %s and %s to %s",
+                        self.name, new.name, destination
+                        )
+        else:
+            logger.info("Sending %s to %s", self.name, destination)
+        commands.append(receiver_argv)
+        return _run_pipeline(commands) is not None
+
+    def _send_commands(self, new, stream_buffer_bytes):
+        """Return btrfs send for new against self, or for self alone.
+
+        Returns a list of argv lists, btrfs send followed by the stream
+        buffer if one was requested and found. Returns None and logs if the
+        snapshot doesn't exist on disk.
         """
         # TODO: Should this verify if new snapshot is actually newer?
-        tmp_path = os.path.join("/", "tmp")
         # both snapshots exist on disk
         if new and new.physical and self.physical:
-            diff_filename = (self.name + "::" + new.name)
-            diff_filepath = os.path.join(tmp_path, diff_filename)
-            if TESTING:
-                print(f"btrfs send -p {self.path} -f {diff_filepath} "
-                      f"{new.path}"
-                      )
-            else:
-                return_val = subprocess.run(
-                            ["btrfs", "send", "-p", self.path, "-f",
-                                diff_filepath, new.path],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-                logger.debug(return_val.stdout)
-                logger.error(return_val.stderr)
-            logger.info(f"Sending difference between {self.name} and "
-                        f"{new.name} to {diff_filepath}"
-                        )
+            commands = [[*_BTRFS_SEND, "-p", self.path, new.path]]
         elif self.physical:
-            diff_filename = "init" + "::" + self.name
-            diff_filepath = os.path.join(tmp_path, diff_filename)
-            if TESTING:
-                print(f"btrfs send -f {diff_filepath} {self.path}")
-            else:
-                subprocess.run(["btrfs", "send", "-f", diff_filepath,
-                               self.path],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-                logger.debug(return_val.stdout)
-                logger.error(return_val.stderr)
-            logger.info(f"Sending {self.name} to {diff_filepath}")
-
-        return filepath  # return path of snapshot diff
+            commands = [[*_BTRFS_SEND, self.path]]
+        else:
+            logger.error("Could not send snapshot at %s. "
+                         "Did not exist on disk.", self.path
+                         )
+            return None
+        if stream_buffer_bytes:
+            buffer_argv = _stream_buffer_argv(stream_buffer_bytes)
+            if buffer_argv is not None:
+                commands.append(buffer_argv)
+        return commands
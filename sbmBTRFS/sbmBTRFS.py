@@ -5,14 +5,15 @@ import argparse  # command line arguments
 import fcntl  # lock files
 import logging
 import os.path
-import shutil  # config file backups
 import sys
 from datetime import datetime, timedelta
 
-import toml
-
 import btrfs_control as btrfs
 
+# pickle, toml readers/writers, tempfile and concurrent.futures are imported
+# where they are used, so runs that don't need them (--help and --version exit
+# while parsing arguments) don't pay for importing them
+
 # TODO: add b2 file as well.
 # TODO: add main stuff.
 # TODO: add command to show snapshot diff changes.
@@ -25,6 +26,7 @@ import btrfs_control as btrfs
 # - log = /var/log/btrfs-sbm.log
 # - main settings = /etc/conf.d/btrfs-sbm.toml
 # - default settings = /etc/conf.d/btrfs-sbm-default.toml (read only)
+# - lock = /etc/conf.d/btrfs-sbm.toml.lock
 
 __version__ = "0.1.1"
 
@@ -32,21 +34,16 @@ __version__ = "0.1.1"
 TESTING = True
 
 
-# make sure we are running with at least python 3.6
+# make sure we are running with at least python 3.10, from which subprocess
+# starts btrfs and the send pipelines with vfork instead of a plain fork
 assert sys.version_info >= (
-    3, 6
-), "You are running an old version of python less than version 3.6. Please \
+    3, 10
+), "You are running an old version of python less than version 3.10. Please \
     upgrade or fix the script yourself."
 
-# only let one instance of script run at a time
-lockfile_path = os.path.join("/", "tmp", "btrfs-sbm.lock")
-lockfile = open(lockfile_path, "a+")
-try:
-    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-except IOError:
-    sys.exit("Multiple instances of script cannot be running at the same "
-             "time. Try running it again in a few minutes"
-             )
+# script logger, btrfs_control logs through its own module logger and both
+# go to the handler set up on the root logger below
+logger = logging.getLogger("btrfs-sbm")
 
 snapshot_subvol_name = ".snapshots"
 
@@ -72,8 +69,8 @@ def b2_send_file(filepath, subvolume):
 def read_config_file(path, type_):
     """Read TOML formatted config file safely.
 
-    Checks to make sure file exists before reading. Handles errors if it
-    does not.
+    Opens the file directly and handles errors if it does not exist, so the
+    file is only looked up once.
     Keyword arguments:
     path -- path of config file as string
     type -- type of config file as string. Default handled differently.
@@ -81,26 +78,240 @@ def read_config_file(path, type_):
     Returns dict
     """
     # try to read config file
-    if os.path.exists(path):
-        try:
-            f = open(path, 'r')  # force read only mode
-        except IOError:
-            logging.error(f"{type_} config file was unable to be "
-                          f"read at {path}!"
-                          )
-            return {}
-        return toml.load(f)
-    else:
+    try:
+        f = open(path, 'rb')  # force read only mode, binary for tomllib
+    except FileNotFoundError:
         if type_ != "default":
-            logging.critical(f"{type_} config file did not exist at {path}!")
+            logger.critical("%s config file did not exist at %s!",
+                            type_, path
+                            )
         else:
-            logging.critical(f"{type_} config file did not exist at {path}! "
-                             f"Using backup values in script"
-                             )
+            logger.critical("%s config file did not exist at %s! "
+                            "Using backup values in script", type_, path
+                            )
+        return {}
+    except OSError:
+        logger.error("%s config file was unable to be read at %s!",
+                     type_, path
+                     )
         return {}
+    with f:
+        # parsed config is cached next to the file, keyed on mtime and size
+        # of the file that was opened, so an unchanged file is never parsed
+        # twice
+        config_stat = os.fstat(f.fileno())
+        cache_key = config_cache_key(config_stat)
+        cache_path = path + ".cache"
+        config = read_config_cache(cache_path, cache_key)
+        if config is not None:
+            return config
+        try:
+            import tomllib as toml_reader  # python 3.11+
+        except ImportError:
+            import tomli as toml_reader  # same API, C accelerated
+        config = toml_reader.load(f)
+    write_config_cache(cache_path, cache_key, config, config_stat.st_mode)
+    return config
+
+
+def config_cache_key(stat):
+    """Return the cache key of a config file from its stat result."""
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def read_config_cache(cache_path, key):
+    """Read parsed config from cache file if it matches key.
+
+    Keyword arguments:
+    cache_path -- path of cache file as string
+    key -- mtime and size of the config file the cache must belong to
+
+    Returns dict, or None if there is no valid cache
+    """
+    import pickle  # parsed config cache
+    try:
+        with open(cache_path, 'rb') as f:
+            if f.readline().rstrip(b"\n") != key.encode():
+                return None  # config file changed since cache was written
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # the cache is only an optimisation, a truncated or stale pickle can
+        # raise about anything. Parse the config file again instead
+        logger.debug("config cache at %s could not be read. "
+                     "See exception %s", cache_path, e
+                     )
+        return None
+
+
+def write_config_cache(cache_path, key, config, mode):
+    """Write parsed config to cache file.
+
+    The cache is written to a uniquely named temporary file first and
+    renamed into place so a partially written cache is never read. It is a
+    copy of the config, so it gets the same permissions as the config.
+    Keyword arguments:
+    cache_path -- path of cache file as string
+    key -- mtime and size of the config file the cache belongs to
+    config -- parsed config as dict
+    mode -- st_mode of the config file
+    """
+    import pickle  # parsed config cache
+    import tempfile  # temporary file next to the cache
+    try:
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(cache_path) + ".",
+            suffix=".tmp",
+            dir=os.path.dirname(os.path.abspath(cache_path))
+        )
+    except OSError as e:
+        logger.warning("config cache could not be written at %s. "
+                       "See exception %s", cache_path, e
+                       )
+        return
+    try:
+        with open(tmp_fd, 'wb') as f:
+            os.fchmod(f.fileno(), mode & 0o7777)
+            f.write(key.encode() + b"\n")
+            pickle.dump(config, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning("config cache could not be written at %s. "
+                       "See exception %s", cache_path, e
+                       )
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def read_default_options(path):
+    """Read default keep options, falling back to values in script.
+
+    Keyword arguments:
+    path -- path of default config file as string
+
+    Returns dict of option name to int
+    """
+    default_options = read_config_file(path, "default")
+    script_defaults = {
+        'keep-hourly': 10,
+        'keep-daily': 10,
+        'keep-weekly': 0,
+        'keep-monthly': 10,
+        'keep-yearly': 10
+    }
+
+    if not default_options:  # empty dict evaluates as false
+        logger.error("default configuration file not found at "
+                     "%s. Using defaults in script", path
+                     )
+        return script_defaults
+    # values are used as snapshot counts, convert them once here
+    options = {}
+    for option, value in default_options.items():
+        try:
+            count = int(value)
+        except (TypeError, ValueError):
+            count = -1
+        if count < 0:
+            count = script_defaults.get(option, 0)
+            logger.error("%s = %r in %s is not a snapshot count. "
+                         "Using %s", option, value, path, count
+                         )
+        options[option] = count
+    for option, count in script_defaults.items():
+        options.setdefault(option, count)  # options missing from the file
+    return options
+
+
+def keep_count(option, value):
+    """Return value of a keep option as a snapshot count.
+
+    Negative counts can't be kept, they are logged and replaced by 0.
+    Keyword arguments:
+    option -- keep-TYPE name of the option, used in the log message
+    value -- configured value
+    """
+    count = int(value)
+    if count < 0:
+        logger.error("%s is %s, can not keep a negative number of "
+                     "snapshots. Using 0", option, count
+                     )
+        return 0
+    return count
+
+
+def update_subvolume(subvolume, time_now):
+    """Take scheduled snapshot of subvolume and remove expired snapshots.
+
+    This is the automatic (cron) work for a single subvolume. It only touches
+    the subvolume object passed in, so several subvolumes can be updated
+    concurrently.
+    Keyword arguments:
+    subvolume -- Subvolume object
+    time_now -- datetime of this run, shared by all subvolumes
+
+    Returns True if a snapshot was taken or deleted
+    """
+    changed = False
+    newest_snapshot = subvolume.newest_snapshot()
+    newest_snapshot_time = newest_snapshot.creation_date_time
+    # if delta between last snapshot and now is at least 1 hour
+    # take a new snapshot
+    if time_now >= newest_snapshot_time + timedelta(hours=1):
+        # assuming subvol and .snapshot directory already exist
+
+        if time_now.hour == 0 and not newest_snapshot_time.hour == 0:
+            type_ = "daily"
+        # begining of week = monday
+        elif (time_now.isoweekday() == 1
+              and not newest_snapshot_time.isoweekday() == 1):
+            type_ = "weekly"
+        # first day of month
+        elif time_now.day == 1 and not newest_snapshot_time.day == 1:
+            type_ = "monthly"
+        # first day of year
+        elif ((time_now.month == 1 and time_now.day == 1)
+                and not (newest_snapshot_time.month == 1
+                         and newest_snapshot_time.day == 1)):
+            type_ = "yearly"
+        else:
+            type_ = "hourly"
+
+        if subvolume.take_snapshot(type_):  # read only snapshot
+            changed = True
+        # TODO: btrfs send diff between snapshots
+        # btrfs_send_snapshot_diff with no "new" path, then
+        # use returned path into b2 updloader tool to do excrytption,
+        # compression and uploads
+
+    # num_snapshots builds a new dict, only evaluate it if it will be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s snapshot counts: %s",
+                     subvolume.name, subvolume.num_snapshots
+                     )
 
+    # check if number of snapshots of each type are over limit, and
+    # remove oldest. Only compares deque lengths unless something expired
+    if subvolume.prune_snapshots():
+        changed = True
+    return changed
 
-def list_subvolumes():
+
+def find_subvolume(subvolumes, subvolume_name):
+    """Return the configured subvolume called subvolume_name.
+
+    Returns None if no subvolume has that name.
+    """
+    # names are checked for duplicates once when the config is loaded, so
+    # stop at the first match
+    return next((subvol for subvol in subvolumes
+                 if subvol.name == subvolume_name), None)
+
+
+def list_subvolumes(args, subvolumes):
     """List known subvolumes with index."""
     fmt_string = "{number:<2}|{name:<10}|{path:<20}"
     print(fmt_string.format(number="", name="Subvolume", path="Path"))
@@ -115,495 +326,701 @@ def list_subvolumes():
                                 )
               )
 
-# first thing, read command line options
-
-
-parser = argparse.ArgumentParser()
-action_group = parser.add_mutually_exclusive_group()
-action_group.add_argument(  # list subvolumes
-    '--list-subvolumes',
-    action='store_true',
-    default=False,
-    help="Prints list of snapshots"
-)
-action_group.add_argument(  # init subvolume
-    '--init-subvolume',
-    action='store',
-    metavar="/path/to/subvolume",
-    help="Initializes subvolume with initial snapshot and configuration"
-)
-action_group.add_argument(  # delete subvolume
-    '--delete-subvolume',
-    action='store',
-    metavar="config-name",
-    help=("removes subvolume configuration from known list, does not "
-          "delete associated snapshots"
-          )
-)
-parser.add_argument(  # delete snapshots
-    '--delete-snapshots',
-    action='store_true',
-    default=False,
-    help=("combine with --delete-subvolume to delete snapshot directory, does "
-          "nothing by itself"
-          )
-)
-action_group.add_argument(  # show subvolume
-    '--show-subvolume',
-    action='store',
-    metavar="snapshot-name",
-    help="prints configuration for specific subvolume"
-)
-action_group.add_argument(  # edit subvolume
-    '--edit-subvolume',
-    action='store',
-    metavar="snapshot-name",
-    help="prompts to change configuration values for specific subvolume"
-)
-action_group.add_argument(  # list snapshot
-    '--list-snapshots',
-    action='store',
-    metavar="snapshot-name",
-    help="prints all snapshots of subvolume"
-)
-action_group.add_argument(  # list all snapshots
-    '--list-all-snapshots',
-    action='store_true',
-    default=False,
-    help="print all snapshots in all subvolumes"
-)
-action_group.add_argument(  # delete snapshot
-    '--delete-snapshot',
-    action='store',
-    metavar="subvolume-name",
-    help="deletes snapshot from subvolume. Snapshot is selected from list"
-)
-parser.add_argument(  # sysconfig dir
-    '--sysconfig-dir',
-    action='store',
-    metavar="/path/to/configfile",
-    help="changes sysconfig directory",
-    default=os.path.join("/", "etc", "conf.d")
-)
-parser.add_argument('--version', action='version', version=__version__)
-parser.add_argument(  # log level
-    '--log-level',
-    action='store',
-    default="WARNING",
-    help="sets logging level"
-)
-args = parser.parse_args()
-
-if TESTING:
-    main_config_file_path = "../test/btrfs-sbm.toml"
-    default_options_file_path = "../test/btrfs-sbm-default.toml"
-else:
-    main_config_file_path = os.path.join(args.sysconfig_dir, "btrfs-sbm.toml")
-    default_options_file_path = os.path.join(args.sysconfig_dir,
-                                             "btrfs-sbm-default.toml")
-
-if TESTING:
-    log_Path = "../test/testlog.log"
-else:
-    log_Path = os.path.join("/", "var", "log", "btrfs-sbm.log")
-
-numeric_log_level = getattr(logging, args.log_level.upper(), None)
-if not isinstance(numeric_log_level, int):
-    raise ValueError(f"Invalid log level: {args.log_level}")
-    sys.exit(1)
-
-logging.basicConfig(filename=log_Path, level=numeric_log_level)
-logging.info("logging started")
-
-main_configuration = {}
-default_options = {}
-
-main_configuration = read_config_file(main_config_file_path, "main")
-
-if not main_configuration:  # empty dict evaluates as false
-    logging.warning(f"main configuration file not found at "
-                    f"{main_config_file_path}. No subvolumes configured. "
-                    f"Please run script with --init-subvolume option to "
-                    f"initialize subvolume. This will create a non empty "
-                    f"config file."
-                    )
-
-default_options = read_config_file(default_options_file_path, "default")
-
-if not default_options:  # empty dict evaluates as false
-    logging.error(f"default configuration file not found at "
-                  f"{default_options_file_path}. Using defaults in script"
-                  )
-    default_options = {
-        'keep-hourly': 10,
-        'keep-daily': 10,
-        'keep-weekly': 0,
-        'keep-monthly': 10,
-        'keep-yearly': 10
-    }
 
-if main_configuration:  # empty dict evaluates as false
+def prompt_keep_count(label, default):
+    """Ask how many snapshots of a type to keep until the answer is valid.
 
-    subvolumes = []
+    Keyword arguments:
+    label -- snapshot type shown in the prompt
+    default -- count used for an empty answer
 
-    # creating subvolume and snapshot objects
-    # for string, dict
-    for subvolume, contents in main_configuration.items():
-        sub_name = subvolume
-        sub_path = contents['path']
-        snapshots_subvol = contents['snapshots-subvol']
-        keep_hourly = contents['keep-hourly']
-        keep_daily = contents['keep-daily']
-        keep_weekly = contents['keep-weekly']
-        keep_monthly = contents['keep-monthly']
-        keep_yearly = contents['keep-yearly']
-        temp_sub = btrfs.Subvolume(sub_path, keep_hourly,
-                                   keep_daily, keep_weekly, keep_monthly,
-                                   keep_yearly
-                                   )
-        for snapshot, data in contents['snapshots'].items():
-            path = data['path']
-            creation_date_time = datetime.fromisoformat(
-                                 data['creation-date-time'])
-            type_ = data['type']
-            temp_snapshot = btrfs.Snapshot(snapshot, path, type_,
-                                           creation_date_time, temp_sub, True
-                                           )
-            temp_sub.append_snapshot(temp_snapshot)
-        temp_sub.sort()  # make sure all snapshots are ordered by creation date
+    Returns int, at least 0
+    """
+    while True:
+        try:
+            tmp = input(f"How many {label} snapshots to keep? "
+                        f"(Default={default}): ")
+        except SyntaxError:  # empty input
+            tmp = ""
+        if tmp == "":
+            return default
+        try:
+            count = int(tmp)
+        except ValueError:
+            print(f"{tmp} is not an integer")
+            continue
+        if count < 0:
+            print(f"{tmp} is less than 0")
+            continue
+        return count
+
+
+def init_subvolume(args, subvolumes):
+    """Initialize subvolume backups."""
+    subvolume_path = args.init_subvolume
+    subvolume_name = os.path.basename(os.path.normpath(subvolume_path))
+
+    keep = dict(args.keep)  # keep-<type> option name to number of snapshots
+    # only prompt for values not given with --keep, and never prompt when
+    # not attached to a terminal so scripted use can't hang
+    interactive = sys.stdin.isatty()
+    default_options = read_default_options(args.default_options_file_path)
+    # (option, snapshot type shown in prompt, default) for each value still
+    # to be chosen, worked out once before prompting
+    prompts = [(option, option.split('-', 1)[1], value)
+               for option, value in default_options.items()
+               if option not in keep]
+    for option, label, default in prompts:
+        if interactive:
+            keep[option] = prompt_keep_count(label, default)
+        else:
+            keep[option] = default
+
+    temp_sub = btrfs.Subvolume(subvolume_path, snapshot_subvol_name,
+                               keep['keep-hourly'], keep['keep-daily'],
+                               keep['keep-weekly'], keep['keep-monthly'],
+                               keep['keep-yearly']
+                               )
+
+    if temp_sub in subvolumes:
+        print(f"subvolume {subvolume_name} is already configured. "
+              f"Please use --show-config or --edit config instead"
+              f"Subvolume names must be unique"
+              )
+        sys.exit(1)  # because this will only be used in interactive mode
+    elif temp_sub.physical:
+        # create first snapshot
+        init_snap = temp_sub.take_snapshot("init")
         subvolumes.append(temp_sub)
+        subvolumes.sort()
+        # init_diff_path = init_snap.send_snapshot_diff()
+        # TODO: send intial snapshot to b2
+        # btrfs_send_snapshot_diff with no "new" path, then
+        # use returned path into b2 uploader tool to do excrytption,
+        # compression # and uploads
+        return True
 
-    subvolumes.sort()  # alphabetize subvolume objects in list
+    else:
+        print(f"{subvolume_path} is not a btrfs subvolume. Please verify "
+              f"you typed it correctly. Make sure to use"
+              )
+        sys.exit(1)  # because this will only be used in interactive mode
 
-    # main command select
-    if args.list_subvolumes:
-        """Lists known subvolumes"""
-        list_subvolumes()
 
-    elif args.init_subvolume is not None:
-        """Initializes subvolume backups"""
-        subvolume_path = args.init_subvolume
-        subvolume_name = os.path.basename(os.path.normpath(subvolume_path))
+def delete_subvolume(args, subvolumes):
+    """Remove subvolume configuration, optionally with its snapshots."""
+    subvolume_name = args.delete_subvolume
 
-        for option, value in default_options.items():
-            # print(config, value)
-            try:
-                tmp = input(f"How many {option.split('-')[1]} "
-                            f"snapshots to keep? (Default={value}): ")
-            except SyntaxError:  # empty input
-                tmp = ""
-
-            if option == "keep-hourly":
-                if tmp != "":
-                    keep_hourly = int(tmp)
-                else:
-                    keep_hourly = int(value)
-            elif option == "keep-daily":
-                if tmp != "":
-                    keep_daily = int(tmp)
-                else:
-                    keep_daily = int(value)
-            elif option == "keep-weekly":
-                if tmp != "":
-                    keep_weekly = int(tmp)
+    temp_sub = find_subvolume(subvolumes, subvolume_name)
+    if temp_sub is not None:  # an empty Subvolume is falsy too
+        if args.delete_snapshots:  # also delete snapshots
+            physical_snapshots = []
+            for snapshot in temp_sub:
+                if snapshot.physical:
+                    physical_snapshots.append(snapshot)
                 else:
-                    keep_weekly = int(value)
-            elif option == "keep-monthly":
-                if tmp != "":
-                    keep_monthly = int(tmp)
-                else:
-                    keep_monthly = int(value)
-            elif option == "keep-yearly":
-                if tmp != "":
-                    keep_yearly = int(tmp)
-                else:
-                    keep_yearly = int(value)
-
-        temp_sub = btrfs.Subvolume(sub_path, snapshot_subvol_name,
-                                   keep_hourly, keep_daily, keep_weekly,
-                                   keep_monthly, keep_yearly
+                    logger.warning("Snapshot: %s did not exist at %s. "
+                                   "Ignoring", snapshot.name, snapshot.path
                                    )
+            # snapshots are kept sorted oldest first, so they are all removed
+            # in creation order, together with the snapshot directory
+            if temp_sub.exists(temp_sub.snapshots_path):  # class method
+                temp_sub.delete_snapshots_subvolume(physical_snapshots)
+            else:
+                temp_sub.delete_snapshots(physical_snapshots)
+                logger.warning("%s subvolume did not exist. This is odd",
+                               snapshot_subvol_name
+                               )
+        # finally, remove subvolume object from list of subvolumes
+        subvolumes.remove(temp_sub)
+        return True
+    else:
+        print(f"{subvolume_name} did not exist in the list of subvolumes. "
+              f"Make sure you typed it correctly or use --list-subvolumes "
+              f"to view configured subvolumes"
+              )
+        sys.exit(1)
 
-        if temp_sub in subvolumes:
-            print(f"subvolume {subvolume_name} is already configured. "
-                  f"Please use --show-config or --edit config instead"
-                  f"Subvolume names must be unique"
-                  )
-            sys.exit(1)  # because this will only be used in interactive mode
-        elif temp_sub.physical:
-            # create first snapshot
-            init_snap = temp_sub.take_snapshot("init")
-            # init_diff_path = init_snap.send_snapshot_diff()
-            # TODO: send intial snapshot to b2
-            # btrfs_send_snapshot_diff with no "new" path, then
-            # use returned path into b2 uploader tool to do excrytption,
-            # compression # and uploads
 
-        else:
-            print(f"{subvolume_path} is not a btrfs subvolume. Please verify "
-                  f"you typed it correctly. Make sure to use"
-                  )
-            sys.exit(1)  # because this will only be used in interactive mode
-
-    elif args.delete_subvolume is not None:
-        subvolume_name = args.delete_subvolume
-
-        # this is a conditional expression and list comprehension.
-        # returns a subset of the subvolumes list that only has elements where
-        # subvol.name == subvolume_name
-        # In theory, since subvolume names should be unique, this will result
-        # in a 1 element list.
-        temp_sub_list = (subvol if subvol.name == subvolume_name else None for
-                         subvol in subvolumes)
-        if len(temp_sub_list) > 1:
-            logging.critical(f"Subvolumes with duplicate names detected, this "
-                             f"should not happen. Check config file for "
-                             f"Multiple instances of {subvolume_name}"
-                             )
-        temp_sub = temp_sub_list[0]  # get only element of list
-        if temp_sub:  # None == False
-            if args.delete_snapshots:  # also delete snapshots
-                for snapshot in temp_sub:
-                    if snapshot.physical:
-                        temp_sub.delete_snapshot(snapshot)  # instance method
-                    else:
-                        logging.warning(f"Snapshot: {snapshot.name} did "
-                                        f"not exist at {snapshot.path}."
-                                        f"Ignoring"
-                                        )
-                # delete snapshot directory last
-                snapshot_subvol_path = os.path.join(temp_sub.path,
-                                                    temp_sub.snapshots_subvol
-                                                    )
-                if temp_sub.exists(snapshot_subvol_path):  # class method
-                    temp_sub.delete(snapshot_subvol_path)  # class method
-                else:
-                    logging.warning(f"{snapshot_subvol_name} subvolume did "
-                                    f"not exist. This is odd"
-                                    )
-            # finally, remove subvolume object from list of subvolumes
-            subvolumes.remove(temp_sub)
-        else:
-            print(f"{subvolume_name} did not exist in the list of subvolumes. "
-                  f"Make sure you typed it correctly or use --list-subvolumes "
-                  f"to view configured subvolumes"
-                  )
-            sys.exit(1)
+def show_subvolume(args, subvolumes):
+    """Print configuration of a subvolume."""
+    subvolume_name = args.show_subvolume
 
-    elif args.show_subvolume is not None:
-        subvolume_name = args.show_subvolume
+    temp_sub = find_subvolume(subvolumes, subvolume_name)
+    if temp_sub is not None:
+        print(temp_sub)
+    else:
+        print(f"{subvolume_name} did not exist in the list of configs. "
+              f"Make sure you typed it correctly or use --list-subvolumes "
+              f"to view configured snapshots"
+              )
+        sys.exit(1)
 
-        temp_sub_list = (subvol if subvol.name == subvolume_name else None for
-                         subvol in subvolumes)
-        if len(temp_sub_list) > 1:
-            logging.critical(f"Subvolumes with duplicate names detected, this "
-                             f"should not happen. Check config file for "
-                             f"Multiple instances of {subvolume_name}"
-                             )
-        temp_sub = temp_sub_list[0]  # get only element of list
 
-        if temp_sub:
-            print(temp_sub)
-        else:
-            print(f"{subvolume_name} did not exist in the list of configs. "
-                  f"Make sure you typed it correctly or use --list-subvolumes "
-                  f"to view configured snapshots"
-                  )
-            sys.exit(1)
+def edit_subvolume(args, subvolumes):
+    """Prompt to change configuration values of a subvolume."""
+    pass
+    # TODO: look into python editor or implement subset myself
 
-    elif args.edit_subvolume is not None:
-        pass
-        # TODO: look into python editor or implement subset myself
-
-    elif args.list_snapshots is not None:
-        subvolume_name = args.list_snapshots
-        temp_sub_list = (subvol if subvol.name == subvolume_name else None for
-                         subvol in subvolumes)
-        if len(temp_sub_list) > 1:
-            logging.critical(f"Subvolumes with duplicate names detected, this "
-                             f"should not happen. Check config file for "
-                             f"Multiple instances of {subvolume_name}"
-                             )
-        temp_sub = temp_sub_list[0]  # get only element of list
-        temp_sub.list_snapshots()  # prints all snapshots in subvolume
 
-    elif args.list_all_snapshots:
-        for subvolume in subvolumes:
-            print("Snapshots in ", subvolume)
-            subvolume.list_snapshots()
-
-    elif args.delete_snapshot is not None:
-        subvolume_name = args.delete_snapshot
-        temp_sub_list = (subvol if subvol.name == subvolume_name else None for
-                         subvol in subvolumes)
-        if len(temp_sub_list) > 1:
-            logging.critical(f"Subvolumes with duplicate names detected, this "
-                             f"should not happen. Check config file for "
-                             f"Multiple instances of {subvolume_name}"
-                             )
-        temp_sub = temp_sub_list[0]  # get only element of list
+def list_snapshots(args, subvolumes):
+    """Print all snapshots of a subvolume."""
+    subvolume_name = args.list_snapshots
+    temp_sub = find_subvolume(subvolumes, subvolume_name)
+    if temp_sub is not None:
         temp_sub.list_snapshots()  # prints all snapshots in subvolume
+    else:
+        print(f"{subvolume_name} did not exist in the list of subvolumes. "
+              f"Make sure you typed it correctly or use --list-subvolumes "
+              f"to view configured subvolumes"
+              )
+        sys.exit(1)
 
-        while True:
-            try:
-                tmp = input("Enter number of the snapshot you want "
-                            "to delete: ")
-            except SyntaxError:  # empty input
-                tmp = ""
-            if tmp == "":
-                print("Exiting!")
-                sys.exit(0)  # this is fine due to interactive command
-            else:
-                try:
-                    index = int(tmp)
-                except ValueError:
-                    print(f"The value you entered, {tmp}, was not an integer. "
-                          f"Please try again.")
-                    continue
-                if index < len(temp_sub):
-                    break
-                else:
-                    print("You entered a number that does not correspond to a "
-                          "known snapshot. Please try again.")
-                    continue
 
-        while True:
+def list_all_snapshots(args, subvolumes):
+    """Print all snapshots in all subvolumes."""
+    for subvolume in subvolumes:
+        print("Snapshots in ", subvolume)
+        subvolume.list_snapshots()
+
+
+def delete_snapshot(args, subvolumes):
+    """Delete a snapshot of a subvolume selected from a list."""
+    subvolume_name = args.delete_snapshot
+    temp_sub = find_subvolume(subvolumes, subvolume_name)
+    if temp_sub is None:
+        print(f"{subvolume_name} did not exist in the list of subvolumes. "
+              f"Make sure you typed it correctly or use --list-subvolumes "
+              f"to view configured subvolumes"
+              )
+        sys.exit(1)
+    temp_sub.list_snapshots()  # prints all snapshots in subvolume
+
+    while True:
+        try:
+            tmp = input("Enter number of the snapshot you want "
+                        "to delete: ")
+        except SyntaxError:  # empty input
+            tmp = ""
+        if tmp == "":
+            print("Exiting!")
+            sys.exit(0)  # this is fine due to interactive command
+        else:
             try:
-                answer = input(f"Is the following the snapshot you "
-                               f"selected for "
-                               f"deletion:\n{temp_sub[index]}\n"
-                               f"Please enter \"Y\" or \"N\".")
-            except SyntaxError:  # empty input
+                index = int(tmp)
+            except ValueError:
+                print(f"The value you entered, {tmp}, was not an integer. "
+                      f"Please try again.")
                 continue
-            if answer.upper() == "N":
-                print("Exiting!")
-                sys.exit(0)  # this is fine due to interactive command
-            elif answer.upper() == "Y":
+            if index < len(temp_sub):
                 break
-                temp_sub.delete_snapshot(temp_sub[index])
             else:
-                print("You did not enter \"Y\" or \"N\". Please try again.")
+                print("You entered a number that does not correspond to a "
+                      "known snapshot. Please try again.")
                 continue
 
-    else:  # automatic functionality
-        time_now = datetime.now()
-
-        # loop through all subvolume configs except default
-        for subvolume in subvolumes:
-
-            snapshot_name = subvolume.name + "-" + time_now.isoformat()
-            snapshot_subvol_path = os.path.join(subvolume.path,
-                                                subvolume.snapshots_subvol)
-
-            newest_snapshot = subvolume.newest_snapshot()
-            newest_snapshot_time = newest_snapshot.creation_date_time
-            # if delta between last snapshot and now is at least 1 hour
-            # take a new snapshot
-            if time_now >= newest_snapshot_time + timedelta(hours=1):
-                # assuming subvol and .snapshot directory already exist
-
-                if time_now.hour == 0 and not newest_snapshot_time.hour == 0:
-                    type_ = "daily"
-                # begining of week = monday
-                elif (time_now.isoweekday() == 1
-                      and not newest_snapshot_time.isoweekday() == 1):
-                    type_ = "weekly"
-                # first day of month
-                elif time_now.day == 1 and not newest_snapshot_time.day == 1:
-                    type_ = "monthly"
-                # first day of year
-                elif ((time_now.month == 1 and time_now.day == 1)
-                        and not (newest_snapshot_time.month == 1
-                                 and newest_snapshot_time.day == 1)):
-                    type_ = "yearly"
-                else:
-                    type_ = "hourly"
-
-                subvolume.take_snapshot(type_)  # read only snapshot
-                # TODO: btrfs send diff between snapshots
-                # btrfs_send_snapshot_diff with no "new" path, then
-                # use returned path into b2 updloader tool to do excrytption,
-                # compression and uploads
-
-            print(subvolume.num_snapshots)
-
-            # check if number of snapshots of each type are over limit, and
-            # remove oldest
-
-            for type_, value in subvolume.num_snapshots.items():
-                if value > subvolume.keep_snapshots[type_]:
-                    # delete oldest snapshots up to max
-                    subvolume.sort()
-                    num_snapshots_over = (
-                                value
-                                - subvolume.keep_snapshots[type_]
-                                )
-                    # now snapshots are sorted oldest first
-                    while num_snapshots_over > 0:
-                        for snapshot in subvolume:
-                            if snapshot.type_ == type_:
-                                subvolume.delete_snapshot()
-                                num_snapshots_over -= 1
+    while True:
+        try:
+            answer = input(f"Is the following the snapshot you "
+                           f"selected for "
+                           f"deletion:\n{temp_sub[index]}\n"
+                           f"Please enter \"Y\" or \"N\".")
+        except SyntaxError:  # empty input
+            continue
+        if answer.upper() == "N":
+            print("Exiting!")
+            sys.exit(0)  # this is fine due to interactive command
+        elif answer.upper() == "Y":
+            temp_sub.delete_snapshot(temp_sub[index])
+            return True
+        else:
+            print("You did not enter \"Y\" or \"N\". Please try again.")
+            continue
+
+
+def update_subvolumes(args, subvolumes):
+    """Automatic functionality, run from cron."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    time_now = datetime.now()
+
+    # subvolumes are independent and the work is spent waiting on btrfs,
+    # so update them in parallel, at most args.jobs at a time
+    max_workers = min(args.jobs, len(subvolumes)) or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(update_subvolume, subvolume, time_now):
+                   subvolume for subvolume in subvolumes}
+        changed = False
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    changed = True
+            except Exception:
+                # log and carry on so the config is still written for the
+                # other subvolumes. The failed one may have taken or deleted
+                # snapshots before failing, so write its state as well
+                logger.exception("Updating subvolume %s failed",
+                                 futures[future].name
+                                 )
+                changed = True
+    return changed
+
+
+def keep_option(value):
+    """Parse a --keep TYPE=NUMBER argument.
+
+    Returns (option, number) tuple, where option is the keep-TYPE name used
+    in config files.
+    """
+    type_, sep, number = value.partition("=")
+    types = ("hourly", "daily", "weekly", "monthly", "yearly")
+    if not sep or type_ not in types:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form "
+                                         f"TYPE=NUMBER, where TYPE is one of "
+                                         f"hourly, daily, weekly, monthly, "
+                                         f"yearly"
+                                         )
+    try:
+        keep = int(number)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{number} is not an integer")
+    if keep < 0:
+        raise argparse.ArgumentTypeError(f"{number} is less than 0")
+    return "keep-" + type_, keep
+
+
+def jobs_option(value):
+    """Parse a --jobs argument.
+
+    Returns int, at least 1
+    """
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not an integer")
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"{value} is less than 1")
+    return jobs
+
+
+class ActionSelect(argparse.Action):
+    """Store an action option and record which one was given.
+
+    The mutually exclusive action options all use this, so the selected
+    action is available as args.action and can be dispatched with a single
+    dict lookup.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        """Store option value and name of selected action."""
+        setattr(namespace, self.dest, True if self.nargs == 0 else values)
+        namespace.action = self.dest
+
+
+# handler for each action option, None is the automatic (cron) run. Handlers
+# that change the subvolumes or their snapshots return True, everything else
+# returns None and the main config is left untouched
+action_handlers = {
+    None: update_subvolumes,
+    'list_subvolumes': list_subvolumes,
+    'init_subvolume': init_subvolume,
+    'delete_subvolume': delete_subvolume,
+    'show_subvolume': show_subvolume,
+    'edit_subvolume': edit_subvolume,
+    'list_snapshots': list_snapshots,
+    'list_all_snapshots': list_all_snapshots,
+    'delete_snapshot': delete_snapshot,
+}
+
+
+def build_parser():
+    """Build the command line argument parser.
+
+    Returns argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser()
+    action_group = parser.add_mutually_exclusive_group()
+    action_group.add_argument(  # list subvolumes
+        '--list-subvolumes',
+        action=ActionSelect,
+        nargs=0,
+        default=False,
+        help="Prints list of snapshots"
+    )
+    action_group.add_argument(  # init subvolume
+        '--init-subvolume',
+        action=ActionSelect,
+        metavar="/path/to/subvolume",
+        help="Initializes subvolume with initial snapshot and configuration"
+    )
+    action_group.add_argument(  # delete subvolume
+        '--delete-subvolume',
+        action=ActionSelect,
+        metavar="config-name",
+        help=("removes subvolume configuration from known list, does not "
+              "delete associated snapshots"
+              )
+    )
+    parser.add_argument(  # delete snapshots
+        '--delete-snapshots',
+        action='store_true',
+        default=False,
+        help=("combine with --delete-subvolume to delete snapshot directory, "
+              "does nothing by itself"
+              )
+    )
+    action_group.add_argument(  # show subvolume
+        '--show-subvolume',
+        action=ActionSelect,
+        metavar="snapshot-name",
+        help="prints configuration for specific subvolume"
+    )
+    action_group.add_argument(  # edit subvolume
+        '--edit-subvolume',
+        action=ActionSelect,
+        metavar="snapshot-name",
+        help="prompts to change configuration values for specific subvolume"
+    )
+    action_group.add_argument(  # list snapshot
+        '--list-snapshots',
+        action=ActionSelect,
+        metavar="snapshot-name",
+        help="prints all snapshots of subvolume"
+    )
+    action_group.add_argument(  # list all snapshots
+        '--list-all-snapshots',
+        action=ActionSelect,
+        nargs=0,
+        default=False,
+        help="print all snapshots in all subvolumes"
+    )
+    action_group.add_argument(  # delete snapshot
+        '--delete-snapshot',
+        action=ActionSelect,
+        metavar="subvolume-name",
+        help="deletes snapshot from subvolume. Snapshot is selected from list"
+    )
+    parser.add_argument(  # keep values for init subvolume
+        '--keep',
+        action='append',
+        type=keep_option,
+        default=[],
+        metavar="TYPE=NUMBER",
+        help=("combine with --init-subvolume to set how many snapshots of "
+              "TYPE to keep instead of being prompted. Can be given multiple "
+              "times"
+              )
+    )
+    parser.add_argument(  # sysconfig dir
+        '--sysconfig-dir',
+        action='store',
+        metavar="/path/to/configfile",
+        help="changes sysconfig directory",
+        default=os.path.join("/", "etc", "conf.d")
+    )
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument(  # log level
+        '--log-level',
+        action='store',
+        default="WARNING",
+        help="sets logging level, one of DEBUG, INFO, WARNING, ERROR, CRITICAL"
+    )
+    parser.add_argument(  # parallel subvolume updates
+        '--jobs',
+        action='store',
+        type=jobs_option,
+        default=8,
+        metavar="N",
+        help=("maximum number of subvolumes snapshotted and pruned in "
+              "parallel by the automatic run. Default 8"
+              )
+    )
+    parser.set_defaults(action=None)
+    return parser
 
 
-else:
-    pass  # continue on and save main config file
+def snapshot_creation_time(name, data):
+    """Return creation time of a snapshot from its main config entry.
 
-# update main config file
+    creation-date-time is the value shown to and edited by users, ctime is
+    the same instant as a unix timestamp. If both are present and name
+    different instants, creation-date-time was most likely edited by hand,
+    so that is used and a warning is logged.
+    Keyword arguments:
+    name -- name of the snapshot, used in the log message
+    data -- snapshot entry of the main config as dict
 
-updated_config = {}
+    Returns naive datetime in local time, like datetime.now()
+    """
+    creation_date_time = datetime.fromisoformat(data['creation-date-time'])
+    if creation_date_time.tzinfo is not None:
+        # written with its UTC offset, convert to local time
+        creation_date_time = datetime.fromtimestamp(
+                             creation_date_time.timestamp())
+    if ('ctime' in data
+            and data['ctime'] != int(creation_date_time.timestamp())):
+        logger.warning("creation-date-time %s and ctime %s of snapshot %s "
+                       "disagree. Using creation-date-time",
+                       data['creation-date-time'], data['ctime'], name
+                       )
+    return creation_date_time
+
+
+def load_subvolumes(main_configuration):
+    """Create subvolume and snapshot objects from the main config.
 
-for subv in subvolumes:
-    sub_dict = {}
-    sub_dict['name'] = subv.name
-    sub_dict['path'] = subv.path
-    sub_dict['snapshots-subvol'] = subv.snapshots_subvol
-    sub_dict['keep-hourly'] = subv.keep_hourly
-    sub_dict['keep-daily'] = subv.keep_daily
-    sub_dict['keep-weekly'] = subv.keep_weekly
-    sub_dict['keep-monthly'] = subv.keep_monthly
-    sub_dict['keep-yearly'] = subv.keep_yearly
-    sub_dict['snapshots'] = {}
+    Keyword arguments:
+    main_configuration -- parsed main config file as dict
 
-    # for snapshot in subvolume
-    for snp in subv:
-        snap_dict = {}
-        snap_dict['path'] = snp.path
-        snap_dict['creation-date-time'] = snp.creation_date_time.isoformat()
-        snap_dict['type'] = snp.type_
+    Returns list of Subvolume objects, sorted by name
+    """
+    subvolumes = []
+    subvolume_names = set()  # names already loaded, to catch duplicates once
 
-        sub_dict['snapshots'][snp.name] = snap_dict
+    # for string, dict
+    for subvolume, contents in main_configuration.items():
+        sub_path = contents['path']
+        snapshots_subvol = contents['snapshots-subvol']
+        keep_hourly = keep_count('keep-hourly', contents['keep-hourly'])
+        keep_daily = keep_count('keep-daily', contents['keep-daily'])
+        keep_weekly = keep_count('keep-weekly', contents['keep-weekly'])
+        keep_monthly = keep_count('keep-monthly', contents['keep-monthly'])
+        keep_yearly = keep_count('keep-yearly', contents['keep-yearly'])
+        temp_sub = btrfs.Subvolume(sub_path, snapshots_subvol, keep_hourly,
+                                   keep_daily, keep_weekly, keep_monthly,
+                                   keep_yearly
+                                   )
+        if temp_sub.name in subvolume_names:
+            logger.critical("Subvolumes with duplicate names detected, this "
+                            "should not happen. Check config file for "
+                            "Multiple instances of %s", temp_sub.name
+                            )
+        subvolume_names.add(temp_sub.name)
+        # snapshots on disk, found with one scan instead of one per snapshot
+        on_disk = temp_sub.scan_snapshots()
+        scanned_dir = os.path.normpath(temp_sub.snapshots_path)
+        for snapshot, data in contents['snapshots'].items():
+            path = data['path']
+            creation_date_time = snapshot_creation_time(snapshot, data)
+            type_ = data['type']
+            # the scan only covers the entries directly in the snapshots
+            # subvolume, anything else is checked by Snapshot.exists
+            norm_path = os.path.normpath(path)
+            if on_disk is None or os.path.dirname(norm_path) != scanned_dir:
+                physical = None
+            else:
+                physical = norm_path in on_disk
+            temp_snapshot = btrfs.Snapshot(snapshot, path, type_,
+                                           creation_date_time, temp_sub, True,
+                                           physical
+                                           )
+            # inserted in creation date order, no sort needed afterwards
+            temp_sub.append_snapshot(temp_snapshot)
+        subvolumes.append(temp_sub)
+
+    subvolumes.sort()  # alphabetize subvolume objects in list
+    return subvolumes
 
-    updated_config[subv.name] = sub_dict
 
-if os.path.exists(main_config_file_path):
+def write_main_config(main_config_file_path, subvolumes):
+    """Write subvolumes and their snapshots to the main config file.
+
+    Keyword arguments:
+    main_config_file_path -- path of main config file as string
+    subvolumes -- list of Subvolume objects
+    """
+    import tempfile  # temporary file next to the main config
+    import tomli_w  # only used to write config files
+
+    updated_config = {}
+
+    for subv in subvolumes:
+        sub_dict = {}
+        sub_dict['name'] = subv.name
+        sub_dict['path'] = subv.path
+        sub_dict['snapshots-subvol'] = subv.snapshots_subvol
+        for type_, keep in subv.keep_snapshots.items():
+            sub_dict['keep-' + type_] = keep
+        snapshots_dict = sub_dict['snapshots'] = {}
+
+        # for snapshot in subvolume
+        for snp in subv:
+            creation_date_time = snp.creation_date_time
+            snapshots_dict[snp.name] = {
+                'path': snp.path,
+                # with the UTC offset, so it names the same instant as ctime
+                # also across a daylight saving change
+                'creation-date-time': creation_date_time.astimezone(
+                    ).isoformat(timespec='seconds'),
+                'ctime': int(creation_date_time.timestamp()),
+                'type': snp.type_
+            }
+
+        updated_config[subv.name] = sub_dict
+
+    if os.path.exists(main_config_file_path):
+        # keep previous version as a hard link to it, so nothing is copied
+        backup_path = main_config_file_path + ".bak"
+        try:
+            try:
+                os.unlink(backup_path)
+            except FileNotFoundError:
+                pass
+            os.link(main_config_file_path, backup_path)
+        except OSError as e:
+            logger.critical("failed to backup main config file. "
+                            "See exception %s", e
+                            )
+            sys.exit(1)
+    else:
+        logger.warning("main config file did not exist. Creating now "
+                       "at %s.", main_config_file_path
+                       )
+
+    # write to a uniquely named temporary file in the same directory and
+    # rename it over the main config file, which atomically replaces it so it
+    # is never left half written. The data is synced before the rename, and
+    # the rename is synced after, so a crash leaves either the old or the new
+    # config
+    config_dir = os.path.dirname(os.path.abspath(main_config_file_path))
+    tmp_config_fd, tmp_config_file_path = tempfile.mkstemp(
+        prefix=os.path.basename(main_config_file_path) + ".",
+        suffix=".tmp",
+        dir=config_dir
+    )
     try:
-        shutil.copy2(main_config_file_path, main_config_file_path + ".bak")
-    except IOError as e:
-        logging.critical(f"failed to backup main config file. "
-                         f"See exception {e}"
-                         )
+        with open(tmp_config_fd, 'wb') as f:  # tomli_w writes bytes
+            tomli_w.dump(updated_config, f)  # write config file
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates it as 0600, keep the mode of the config it
+        # replaces so permissions set by an admin are not changed
+        try:
+            config_mode = os.stat(main_config_file_path).st_mode & 0o7777
+        except FileNotFoundError:
+            config_mode = 0o644
+        os.chmod(tmp_config_file_path, config_mode)
+        os.replace(tmp_config_file_path, main_config_file_path)
+        config_dir_fd = os.open(config_dir, os.O_RDONLY)
+        try:
+            os.fsync(config_dir_fd)
+        finally:
+            os.close(config_dir_fd)
+    except OSError as e:
+        try:
+            os.unlink(tmp_config_file_path)
+        except FileNotFoundError:
+            pass  # already renamed into place
+        logger.critical("main config file could not be written at "
+                        "%s. See exception %s", main_config_file_path, e
+                        )
         sys.exit(1)
+
+    # the main config is rewritten on every run, so refresh its cache now or
+    # the next run would always miss it and parse the toml again
+    config_stat = os.stat(main_config_file_path)
+    write_config_cache(main_config_file_path + ".cache",
+                       config_cache_key(config_stat), updated_config,
+                       config_stat.st_mode
+                       )
+
+
+def main():
+    """Run the action selected on the command line."""
+    # first thing, read command line options
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if TESTING:
+        main_config_file_path = "../test/btrfs-sbm.toml"
+        default_options_file_path = "../test/btrfs-sbm-default.toml"
+    else:
+        main_config_file_path = os.path.join(args.sysconfig_dir,
+                                             "btrfs-sbm.toml")
+        default_options_file_path = os.path.join(args.sysconfig_dir,
+                                                 "btrfs-sbm-default.toml")
+
+    # only let one instance of script run at a time. The lock is a POSIX
+    # record lock on a file next to the main config, so it lives on the same
+    # filesystem as what it protects and works over NFS. The main config
+    # itself can't be locked since it is atomically replaced, which gives it
+    # a new inode. The fd is held open (and the lock with it) until the
+    # process exits
+    lockfile_path = main_config_file_path + ".lock"
     try:
-        f = open(main_config_file_path, 'w')  # overwrites file
-    except IOError as e:
-        logging.critical(f"main config file could not be opened. "
-                         f"See exception {e}"
-                         )
-        sys.exit(1)
-    toml.dump(updated_config, f)  # write config file
-else:
-    logging.warning(f"main config file did not exist. Creating now "
-                    f"at {main_config_file_path}."
-                    )
+        lockfile_fd = os.open(lockfile_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        sys.exit(f"Could not open lock file at {lockfile_path}. "
+                 f"See exception {e}"
+                 )
     try:
-        f = open(main_config_file_path,
-                 'w+')  # create and update file (truncates)
-    except IOError as e:
-        logging.critical(f"Could not create new config file at "
-                         f"{main_config_file_path}. See exception {e}"
-                         )
-        sys.exit(1)
-    toml.dump(updated_config, f)  # write config file
+        fcntl.lockf(lockfile_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.exit("Multiple instances of script cannot be running at the same "
+                 "time. Try running it again in a few minutes"
+                 )
+
+    if TESTING:
+        log_Path = "../test/testlog.log"
+    else:
+        log_Path = os.path.join("/", "var", "log", "btrfs-sbm.log")
+
+    # explicit table, so names like "Logger" that happen to exist in the
+    # logging module aren't accepted as levels
+    log_levels = {
+        'DEBUG': logging.DEBUG,
+        'INFO': logging.INFO,
+        'WARNING': logging.WARNING,
+        'ERROR': logging.ERROR,
+        'CRITICAL': logging.CRITICAL
+    }
+    numeric_log_level = log_levels.get(args.log_level.upper())
+    if numeric_log_level is None:
+        parser.error(f"Invalid log level: {args.log_level}. Must be one of "
+                     f"{', '.join(log_levels)}"
+                     )
+
+    # not needed for --help/--version
+    from logging.handlers import WatchedFileHandler
+
+    # delay opening the log file until the first record is emitted, runs that
+    # don't log anything at the configured level never touch it.
+    # WatchedFileHandler reopens the log file after logrotate moves it
+    log_handler = WatchedFileHandler(log_Path, delay=True)
+    logging.basicConfig(handlers=[log_handler], level=numeric_log_level,
+                        format="%(asctime)s %(name)s %(levelname)s "
+                               "%(message)s",
+                        force=True
+                        )
+    logger.info("logging started")
+
+    main_configuration = read_config_file(main_config_file_path, "main")
+
+    if not main_configuration:  # empty dict evaluates as false
+        logger.warning("main configuration file not found at "
+                       "%s. No subvolumes configured. "
+                       "Please run script with --init-subvolume option to "
+                       "initialize subvolume. This will create a non empty "
+                       "config file.", main_config_file_path
+                       )
+
+    # handlers only get args and subvolumes. The default options are only
+    # needed by init_subvolume, so only read there
+    args.default_options_file_path = default_options_file_path
+
+    subvolumes = load_subvolumes(main_configuration)
+
+    # main command select
+    changed = action_handlers[args.action](args, subvolumes)
+
+    # update main config file, only if there is something new to write
+    if changed:
+        write_main_config(main_config_file_path, subvolumes)
+    else:
+        logger.debug("nothing changed, not writing main config file")
+
+    logging.shutdown()
+
 
-logging.shutdown()
+if __name__ == "__main__":
+    main()